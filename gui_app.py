@@ -1,5 +1,8 @@
+import multiprocessing
 import sys
+import threading
 import tkinter as tk
+from collections import deque
 from tkinter.filedialog import askdirectory
 
 import sv_ttk
@@ -9,29 +12,45 @@ from igc_parser import parse_flights
 
 class StdoutRedirector(object):
 
+    FLUSH_INTERVAL_MS = 100
+
     def __init__(self, text_widget: tk.Text):
         """Redirect stdout to a tkinter textbox
 
+        Writes are buffered and periodically flushed to the textbox from the
+        tkinter main loop, so they can come from any thread.
+
         Args:
             text_widget (tk.Text): textbox
         """
         self.textbox = text_widget
+        self.buffer = deque()
+        self.textbox.after(self.FLUSH_INTERVAL_MS, self._flush)
 
     def write(self, string: str):
-        """Write a string to the textbox
+        """Queue a string to be written to the textbox
 
         Args:
             string (str): string to write
         """
-        self.textbox.configure(state='normal')
-        self.textbox.insert('end', string)
-        self.textbox.see('end')
-        self.textbox.configure(state='disabled')
+        self.buffer.append(string)
 
     def flush(self):
-        """Flush to avoid delay in output
+        """Nothing to do, buffered output is written by the main loop
+        """
+
+    def _flush(self):
+        """Write buffered strings to the textbox and reschedule
         """
-        self.textbox.update_idletasks()
+        if self.buffer:
+            strings = []
+            while self.buffer:
+                strings.append(self.buffer.popleft())
+            self.textbox.configure(state='normal')
+            self.textbox.insert('end', ''.join(strings))
+            self.textbox.see('end')
+            self.textbox.configure(state='disabled')
+        self.textbox.after(self.FLUSH_INTERVAL_MS, self._flush)
 
 
 class Gui(object):
@@ -73,12 +92,11 @@ class Gui(object):
         csv_filename_entry.insert(0, "flightbook.csv")
         csv_filename_entry.grid(row=2, column=1, padx=5, pady=2)
 
-        start_button = tk.ttk.Button(
+        self.start_button = tk.ttk.Button(
             self.parent,
             text="Start",
-            command=lambda: parse_flights(self.igc_folder_var.get(
-            ), self.csv_folder_var.get(), csv_filename_entry.get()))
-        start_button.grid(row=3, column=0, padx=5, pady=2, columnspan=2)
+            command=lambda: self.start(csv_filename_entry.get()))
+        self.start_button.grid(row=3, column=0, padx=5, pady=2, columnspan=2)
         self.text_box = tk.Text(self.parent,
                                 wrap='word',
                                 height=5,
@@ -88,6 +106,33 @@ class Gui(object):
         sys.stdout = StdoutRedirector(self.text_box)
         sv_ttk.set_theme("dark")
 
+    def start(self, output_filename: str):
+        """Run parse_flights in a background thread, with the start button
+        disabled until it finishes
+
+        Args:
+            output_filename (str): name of output csv file
+        """
+        self.start_button.configure(state='disabled')
+        thread = threading.Thread(target=parse_flights,
+                                  args=(self.igc_folder_var.get(),
+                                        self.csv_folder_var.get(),
+                                        output_filename),
+                                  daemon=True)
+        thread.start()
+        self.wait_for_run(thread)
+
+    def wait_for_run(self, thread: threading.Thread):
+        """Re-enable the start button once the run has finished
+
+        Args:
+            thread (threading.Thread): thread running parse_flights
+        """
+        if thread.is_alive():
+            self.parent.after(100, self.wait_for_run, thread)
+        else:
+            self.start_button.configure(state='normal')
+
     def set_folder(self, folder_path_target: tk.StringVar, label: tk.Label):
         """Set a label to a folder selected by user
 
@@ -96,12 +141,12 @@ class Gui(object):
             label (tk.Label): the label to set
         """
         if directory := askdirectory():
-            folder_path_target.set(str(directory))
-        if str(folder_path_target.get()):
-            label.config(text=str(folder_path_target.get()))
+            folder_path_target.set(directory)
+            label.config(text=directory)
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     root = tk.Tk()
     root.title('Flightbook Generator')
     gui = Gui(root)
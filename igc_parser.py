@@ -1,118 +1,709 @@
 import argparse
-from datetime import datetime
+import asyncio
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import lru_cache, partial
 from pathlib import Path
-from statistics import median
-from typing import Dict, Union
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+from urllib.error import URLError
 
+import numpy as np
 import overpy
 import pandas as pd
-from geopy.distance import distance
+from geopy.adapters import AioHTTPAdapter
+from geopy.exc import GeocoderServiceError
+from geopy.extra.rate_limiter import AsyncRateLimiter, RateLimiter
 from geopy.geocoders import Nominatim
-from geopy.location import Location
+from scipy.spatial import cKDTree
 
 import igc_lib
+import lib.geo as geo
 
+try:
+    import reverse_geocoder
+except ImportError:  # optional offline reverse geocoding backend
+    reverse_geocoder = None
 
-def find_closest_peak_to_location(location: Location,
-                                  search_radius_meters: int = 2000) -> str:
-    """Finds the closest mountain peak to a geopy Location within a given
-    search radius
+CACHE_DIR = Path.home() / '.cache' / 'flightbook'
+MAX_WORKERS = 8
+CHECKPOINT_INTERVAL = 50  # write intermediate results every n flights
+# offline matches further away than this fall back to Nominatim
+OFFLINE_MAX_DISTANCE_KM = 5
+PEAK_SEARCH_RADIUS_METERS = 2000
+OVERPASS_MAX_ATTEMPTS = 4
+OVERPASS_TIMEOUT_SECONDS = 180
+# larger regions fall back to one Overpass query per flight
+MAX_BBOX_DEGREES = 2.0
+PEAK_TILES_PER_DEGREE = 10  # peaks are cached in 0.1 degree tiles
+
+# set FLIGHTBOOK_NOMINATIM_DOMAIN (and FLIGHTBOOK_NOMINATIM_SCHEME) to use a
+# self-hosted Nominatim server, which is queried without throttling
+NOMINATIM_DOMAIN = os.environ.get('FLIGHTBOOK_NOMINATIM_DOMAIN',
+                                  'nominatim.openstreetmap.org')
+NOMINATIM_SCHEME = os.environ.get('FLIGHTBOOK_NOMINATIM_SCHEME', 'https')
+if NOMINATIM_DOMAIN == 'nominatim.openstreetmap.org':
+    NOMINATIM_MIN_DELAY_SECONDS = 1.1
+    NOMINATIM_CONCURRENCY = 1
+else:
+    NOMINATIM_MIN_DELAY_SECONDS = 0
+    NOMINATIM_CONCURRENCY = MAX_WORKERS
+# set FLIGHTBOOK_OVERPASS_URL to use a different Overpass mirror
+OVERPASS_URL = os.environ.get('FLIGHTBOOK_OVERPASS_URL',
+                              'https://overpass-api.de/api/interpreter')
+_PEAKS_AROUND_QUERY = 'node[natural=peak](around:{radius},{lat},{lon});out;'
+_PEAKS_IN_BBOX_QUERY = 'node[natural=peak]({min_lat},{min_lon},{max_lat},{max_lon});out;'
+
+LatLon = Tuple[float, float]
+FlightDetails = Dict[str, Union[str, int, float]]
+ParsedFlight = Tuple[FlightDetails, LatLon, LatLon]
+
+# reverse geocoding results keyed by coordinates rounded to ~100m
+_reverse_cache: Dict[str, dict] = {}
+# closest peak names keyed by rounded coordinates and search radius
+_peak_cache: Dict[str, str] = {}
+# peaks keyed by 0.1 degree tile
+_peak_tile_cache: Dict[str, dict] = {}
+# flight details keyed by IGC file name, size and modification time
+_flight_cache: Dict[str, dict] = {}
+# one lock per cache key so concurrent misses on a key query only once
+_key_locks: Dict[str, threading.Lock] = {}
+_key_locks_lock = threading.Lock()
+
+# shared clients so connections are reused across lookups
+_geolocator = Nominatim(user_agent="igc_flightbook",
+                        domain=NOMINATIM_DOMAIN,
+                        scheme=NOMINATIM_SCHEME,
+                        timeout=15)
+_overpass_api = overpy.Overpass(url=OVERPASS_URL)
+# overpy opens its connections without a timeout, bound stalled reads with the
+# default socket timeout so they fail and are retried (geopy sets its own)
+socket.setdefaulttimeout(OVERPASS_TIMEOUT_SECONDS)
+# shared between workers to respect the usage policies of the public
+# Nominatim (1 request/s) and Overpass instances
+_reverse = RateLimiter(_geolocator.reverse,
+                       min_delay_seconds=NOMINATIM_MIN_DELAY_SECONDS,
+                       max_retries=3,
+                       error_wait_seconds=10,
+                       swallow_exceptions=False)
+_rate_limited_overpass_query = RateLimiter(_overpass_api.query,
+                                           min_delay_seconds=2,
+                                           max_retries=0,
+                                           swallow_exceptions=False)
+
+
+def _is_transient_overpass_error(error: Exception) -> bool:
+    """Check if an Overpass query failed because the server was overloaded
+    or timed out, which is worth retrying
 
     Args:
-        location (Location): location to search around
-        search_radius_meters (int, optional): search radius in meters. Defaults to 2000.
+        error (Exception): error raised by the query
 
     Returns:
-        str: name of the closest peak or 'Unknown Location' in case of errors
+        bool: True for timeouts, 429 and 504 responses, False otherwise
+    """
+    if isinstance(error, URLError):
+        return isinstance(error.reason, TimeoutError)
+    return isinstance(error, (overpy.exception.OverpassTooManyRequests,
+                              overpy.exception.OverpassGatewayTimeout,
+                              TimeoutError))
+
+
+def _query_overpass(query: str) -> overpy.Result:
+    """Run a rate limited Overpass query, retrying transient errors with
+    exponential backoff
+
+    Args:
+        query (str): Overpass QL query
+
+    Returns:
+        overpy.Result: query result
+    """
+    for attempt in range(OVERPASS_MAX_ATTEMPTS):
+        try:
+            return _rate_limited_overpass_query(query)
+        except (overpy.exception.OverPyException, OSError) as e:
+            if not _is_transient_overpass_error(
+                    e) or attempt == OVERPASS_MAX_ATTEMPTS - 1:
+                raise
+            time.sleep(min(2 * 2**attempt, 60))
+
+
+def _load_cache(name: str) -> dict:
+    """Load a json cache from the cache directory
+
+    Args:
+        name (str): name of the cache
+
+    Returns:
+        dict: cached entries, empty if the cache does not exist or is broken
     """
     try:
-        api = overpy.Overpass()
-        response = api.query(f"""
-            node[natural=peak](around:{search_radius_meters}, {location.raw['lat']}, {location.raw['lon']});
-            out;
-            """)
+        with open(CACHE_DIR / f'{name}.json', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-        peak_list = []
-        for node in response.nodes:
-            if 'ele' in node.tags.keys() and 'name' in node.tags.keys():
-                tr = {
-                    ord('m'): None,
-                    ord(','): '.'
-                }  # mitigate some mapping errors
-                ele = float(node.tags['ele'].translate(tr).replace(
-                    ' Meter', ''))
-                lat = float(node.lat)
-                lon = float(node.lon)
-                dist = distance((lat, lon),
-                                (location.raw['lat'], location.raw['lon']))
-                peak_list.append({
-                    'elevation': ele,
-                    'latitude': lat,
-                    'longitude': lon,
-                    'distance': dist.kilometers,
-                    'name': node.tags['name']
-                })
-        peaks_sorted = sorted(peak_list, key=lambda k: int(k['distance']))
-
-        return peaks_sorted[0].get(
-            'name', 'Unknown Location') if peaks_sorted else 'Unknown Location'
-    except:
+
+def _save_cache(name: str, cache: dict):
+    """Write a json cache to the cache directory
+
+    Args:
+        name (str): name of the cache
+        cache (dict): entries to store
+    """
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_file = CACHE_DIR / f'{name}.json.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(cache, f)
+        tmp_file.replace(CACHE_DIR / f'{name}.json')
+    except OSError as e:
+        print(f'Could not write cache {name}: {e}')
+
+
+def _key_lock(key: str) -> threading.Lock:
+    """Get the lock guarding the lookup of a cache key
+
+    Args:
+        key (str): cache key
+
+    Returns:
+        threading.Lock: lock shared by all lookups of the key
+    """
+    with _key_locks_lock:
+        return _key_locks.setdefault(key, threading.Lock())
+
+
+def _reverse_cache_key(lat: float, lon: float) -> str:
+    """Round a position to ~100m for use as reverse geocoding cache key
+
+    Args:
+        lat (float): latitude in degrees
+        lon (float): longitude in degrees
+
+    Returns:
+        str: rounded position formatted as Nominatim query
+    """
+    return f"{lat:.3f},{lon:.3f}"
+
+
+def reverse_geocode(reverse: Callable, lat: float,
+                    lon: float) -> Optional[dict]:
+    """Reverse geocode a position, reusing results for positions within ~100m
+
+    Args:
+        reverse (Callable): (rate limited) geocoder reverse function to query on cache misses
+        lat (float): latitude in degrees
+        lon (float): longitude in degrees
+
+    Returns:
+        Optional[dict]: raw Nominatim response, empty if nothing was found,
+        None if the lookup failed
+    """
+    key = _reverse_cache_key(lat, lon)
+    if key in _reverse_cache:
+        return _reverse_cache[key]
+    with _key_lock(key):
+        # another worker may have looked up the key while we waited
+        if key in _reverse_cache:
+            return _reverse_cache[key]
+        try:
+            location = reverse(key)
+        except GeocoderServiceError as e:
+            print(f'Reverse geocoding {key} failed: {e}')
+            return None
+        raw = location.raw if location is not None else {}
+        _reverse_cache[key] = raw
+    return raw
+
+
+@lru_cache(maxsize=None)
+def _get_offline_geocoder():
+    """Load the offline reverse geocoder if it is installed
+
+    Returns:
+        reverse_geocoder.RGeocoder: the geocoder or None if not available
+    """
+    if reverse_geocoder is None:
+        return None
+    return reverse_geocoder.RGeocoder(mode=1, verbose=False)
+
+
+async def _prefetch_reverse_geocoding(keys: List[str]):
+    """Reverse geocode positions concurrently and store the results in the
+    reverse geocoding cache
+
+    Args:
+        keys (List[str]): rounded positions as used as cache keys
+    """
+    async with Nominatim(user_agent="igc_flightbook",
+                         domain=NOMINATIM_DOMAIN,
+                         scheme=NOMINATIM_SCHEME,
+                         timeout=15,
+                         adapter_factory=AioHTTPAdapter) as geolocator:
+        reverse = AsyncRateLimiter(geolocator.reverse,
+                                   min_delay_seconds=NOMINATIM_MIN_DELAY_SECONDS,
+                                   max_retries=3,
+                                   error_wait_seconds=10,
+                                   swallow_exceptions=False)
+        semaphore = asyncio.Semaphore(NOMINATIM_CONCURRENCY)
+
+        async def fetch(key: str):
+            async with semaphore:
+                try:
+                    location = await reverse(key)
+                except GeocoderServiceError:
+                    return  # retried by the regular lookup
+            _reverse_cache[key] = location.raw if location is not None else {}
+
+        await asyncio.gather(*(fetch(key) for key in keys))
+
+
+def prefetch_landing_places(landings: List[LatLon]):
+    """Reverse geocode all landing positions which are neither cached nor
+    resolved offline with asyncio, if aiohttp is installed
+
+    Args:
+        landings (List[LatLon]): landing positions (lat, lon) in degrees
+    """
+    if not AioHTTPAdapter.is_available:
+        return
+    keys = {
+        _reverse_cache_key(lat, lon)
+        for lat, lon in landings if _find_offline_place(lat, lon) is None
+    } - _reverse_cache.keys()
+    if keys:
+        print(f'Looking up {len(keys)} landing places.', flush=True)
+        asyncio.run(_prefetch_reverse_geocoding(sorted(keys)))
+
+
+def _find_offline_place(lat: float, lon: float) -> Optional[str]:
+    """Find the name of the closest city with the offline geocoder
+
+    Args:
+        lat (float): latitude in degrees
+        lon (float): longitude in degrees
+
+    Returns:
+        Optional[str]: name of the city, None if the offline geocoder is not
+        available or there is no city close enough
+    """
+    offline_geocoder = _get_offline_geocoder()
+    if offline_geocoder is None:
+        return None
+    place = offline_geocoder.query([(lat, lon)])[0]
+    if geo.earth_distance(lat, lon, float(place['lat']), float(
+            place['lon'])) > OFFLINE_MAX_DISTANCE_KM:
+        return None
+    return place['name']
+
+
+def find_landing_place(reverse: Callable, lat: float,
+                       lon: float) -> Optional[str]:
+    """Find the name of the city or village at a position, using the offline
+    geocoder if available and Nominatim otherwise
+
+    Args:
+        reverse (Callable): (rate limited) geocoder reverse function
+        lat (float): latitude in degrees
+        lon (float): longitude in degrees
+
+    Returns:
+        Optional[str]: name of the city or village, empty if nothing was
+        found, None if the lookup failed
+    """
+    place = _find_offline_place(lat, lon)
+    if place is not None:
+        return place
+    location = reverse_geocode(reverse, lat, lon)
+    if location is None:
+        return None
+    address = location.get('address', {})
+    city = address.get("city", '')
+    return city if city else address.get("village", '')
+
+
+def _haversine_km(lat: float, lon: float, lats: np.ndarray,
+                  lons: np.ndarray) -> np.ndarray:
+    """Great circle distances from a position to an array of positions
+
+    Args:
+        lat (float): latitude in degrees
+        lon (float): longitude in degrees
+        lats (np.ndarray): latitudes in degrees
+        lons (np.ndarray): longitudes in degrees
+
+    Returns:
+        np.ndarray: distances in kilometers
+    """
+    lat, lon = np.radians(lat), np.radians(lon)
+    lats, lons = np.radians(lats), np.radians(lons)
+    a = (np.sin((lats - lat) / 2)**2 +
+         np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2)**2)
+    return 2 * geo.EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def _query_closest_peak(lat: float, lon: float,
+                        search_radius_meters: int) -> str:
+    """Query Overpass for the closest mountain peak to a position within a
+    given search radius
+
+    Args:
+        lat (float): latitude in degrees to search around
+        lon (float): longitude in degrees to search around
+        search_radius_meters (int): search radius in meters
+
+    Returns:
+        str: name of the closest peak or 'Unknown Location' if there is none
+    """
+    response = _query_overpass(
+        _PEAKS_AROUND_QUERY.format(radius=search_radius_meters,
+                                   lat=lat,
+                                   lon=lon))
+
+    lats, lons, names = [], [], []
+    for node in response.nodes:
+        if 'ele' in node.tags and 'name' in node.tags:
+            lats.append(float(node.lat))
+            lons.append(float(node.lon))
+            names.append(node.tags['name'])
+    if not names:
         return 'Unknown Location'
+    distances = _haversine_km(lat, lon, np.array(lats), np.array(lons))
+
+    return names[distances.argmin()]
+
+
+def find_closest_peak_to_location(
+        lat: float,
+        lon: float,
+        search_radius_meters: int = PEAK_SEARCH_RADIUS_METERS
+) -> Optional[str]:
+    """Finds the closest mountain peak to a position within a given search
+    radius, reusing results for positions within ~100m
+
+    Args:
+        lat (float): latitude in degrees to search around
+        lon (float): longitude in degrees to search around
+        search_radius_meters (int, optional): search radius in meters. Defaults to 2000.
+
+    Returns:
+        Optional[str]: name of the closest peak, 'Unknown Location' if there
+        is none, None if the lookup failed
+    """
+    key = f"{lat:.3f},{lon:.3f},{search_radius_meters}"
+    if key in _peak_cache:
+        return _peak_cache[key]
+    with _key_lock(key):
+        # another worker may have looked up the key while we waited
+        if key in _peak_cache:
+            return _peak_cache[key]
+        try:
+            peak = _query_closest_peak(lat, lon, search_radius_meters)
+        except (overpy.exception.OverPyException, OSError) as e:
+            print(f'Could not look up peak near {lat},{lon}: {e}')
+            return None
+        _peak_cache[key] = peak
+    return peak
+
+
+class PeakIndex(object):
+
+    def __init__(self, lats: np.ndarray, lons: np.ndarray, names: List[str]):
+        """Spatial index over named mountain peaks for nearest peak lookups
+
+        Args:
+            lats (np.ndarray): peak latitudes in degrees
+            lons (np.ndarray): peak longitudes in degrees
+            names (List[str]): peak names
+        """
+        self.names = names
+        # equirectangular projection, accurate enough within a small region
+        self.lon_scale = np.cos(np.radians(np.mean(lats))) if names else 1.0
+        self.tree = cKDTree(self._project(lats, lons)) if names else None
+
+    def _project(self, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+        """Project positions to the plane the index is built in
+
+        Args:
+            lats (np.ndarray): latitudes in degrees
+            lons (np.ndarray): longitudes in degrees
+
+        Returns:
+            np.ndarray: projected positions in radians, one row per position
+        """
+        return np.column_stack(
+            (np.radians(lats), np.radians(lons) * self.lon_scale))
+
+    def closest(self,
+                lat: float,
+                lon: float,
+                search_radius_meters: int = PEAK_SEARCH_RADIUS_METERS) -> str:
+        """Find the closest peak to a position within a given search radius
+
+        Args:
+            lat (float): latitude in degrees to search around
+            lon (float): longitude in degrees to search around
+            search_radius_meters (int, optional): search radius in meters. Defaults to 2000.
+
+        Returns:
+            str: name of the closest peak or 'Unknown Location' if there is none
+        """
+        if self.tree is None:
+            return 'Unknown Location'
+        dist, idx = self.tree.query(self._project(np.array([lat]),
+                                                  np.array([lon]))[0])
+        if dist * geo.EARTH_RADIUS_KM * 1000 > search_radius_meters:
+            return 'Unknown Location'
+        return self.names[idx]
+
+
+def _peak_tile_key(tile_lat: int, tile_lon: int) -> str:
+    """Format a peak tile as key for the peak tile cache
+
+    Args:
+        tile_lat (int): latitude of the tile in units of the tile size
+        tile_lon (int): longitude of the tile in units of the tile size
+
+    Returns:
+        str: cache key of the tile
+    """
+    return f"{tile_lat},{tile_lon}"
+
+
+def _peak_tiles(min_lat: float, min_lon: float, max_lat: float,
+                max_lon: float) -> List[Tuple[int, int]]:
+    """List the peak cache tiles overlapping a bounding box
+
+    Args:
+        min_lat (float): southern bound in degrees
+        min_lon (float): western bound in degrees
+        max_lat (float): northern bound in degrees
+        max_lon (float): eastern bound in degrees
+
+    Returns:
+        List[Tuple[int, int]]: tiles as (lat, lon) in units of the tile size
+    """
+    return [(tile_lat, tile_lon) for tile_lat in range(
+        math.floor(min_lat * PEAK_TILES_PER_DEGREE),
+        math.floor(max_lat * PEAK_TILES_PER_DEGREE) + 1)
+            for tile_lon in range(
+                math.floor(min_lon * PEAK_TILES_PER_DEGREE),
+                math.floor(max_lon * PEAK_TILES_PER_DEGREE) + 1)]
+
 
+def fetch_peaks(positions: List[LatLon],
+                search_radius_meters: int = PEAK_SEARCH_RADIUS_METERS
+                ) -> Optional[PeakIndex]:
+    """Fetch all named peaks around a set of positions. Peaks are cached in
+    tiles, only tiles which were not fetched by a previous run are queried
+    from Overpass with a single query over their bounding box
 
-def parse_flight_details(igc_path: Path) -> Dict[str, Union[str, int, float]]:
-    """Parse an igc file and return details about the flight
+    Args:
+        positions (List[LatLon]): positions (lat, lon) in degrees to cover
+        search_radius_meters (int, optional): margin around the positions in meters. Defaults to 2000.
+
+    Raises:
+        overpy.exception.OverPyException, OSError: if the Overpass query failed
+
+    Returns:
+        Optional[PeakIndex]: index of the peaks or None if the bounding box is
+        too large
+    """
+    lats, lons = np.array(positions).T
+    margin_lat = np.degrees(search_radius_meters / 1000 / geo.EARTH_RADIUS_KM)
+    margin_lon = margin_lat / np.cos(np.radians(np.abs(lats).max()))
+    min_lat, max_lat = lats.min() - margin_lat, lats.max() + margin_lat
+    min_lon, max_lon = lons.min() - margin_lon, lons.max() + margin_lon
+    if max(max_lat - min_lat, max_lon - min_lon) > MAX_BBOX_DEGREES:
+        return None
+    tiles = _peak_tiles(min_lat, min_lon, max_lat, max_lon)
+    missing_tiles = [
+        tile for tile in tiles if _peak_tile_key(*tile) not in _peak_tile_cache
+    ]
+    if missing_tiles:
+        missing_lats, missing_lons = zip(*missing_tiles)
+        fetched_tiles = {
+            _peak_tile_key(*tile): {
+                'lats': [],
+                'lons': [],
+                'names': []
+            }
+            for tile in itertools.product(
+                range(min(missing_lats), max(missing_lats) + 1),
+                range(min(missing_lons), max(missing_lons) + 1))
+        }
+        response = _query_overpass(
+            _PEAKS_IN_BBOX_QUERY.format(
+                min_lat=min(missing_lats) / PEAK_TILES_PER_DEGREE,
+                min_lon=min(missing_lons) / PEAK_TILES_PER_DEGREE,
+                max_lat=(max(missing_lats) + 1) / PEAK_TILES_PER_DEGREE,
+                max_lon=(max(missing_lons) + 1) / PEAK_TILES_PER_DEGREE))
+        for node in response.nodes:
+            if 'ele' in node.tags and 'name' in node.tags:
+                lat, lon = float(node.lat), float(node.lon)
+                tile = fetched_tiles.get(
+                    _peak_tile_key(math.floor(lat * PEAK_TILES_PER_DEGREE),
+                                   math.floor(lon * PEAK_TILES_PER_DEGREE)))
+                if tile is not None:  # nodes on the outer edge of the box
+                    tile['lats'].append(lat)
+                    tile['lons'].append(lon)
+                    tile['names'].append(node.tags['name'])
+        _peak_tile_cache.update(fetched_tiles)
+
+    peak_lats, peak_lons, names = [], [], []
+    for tile in tiles:
+        cached_tile = _peak_tile_cache[_peak_tile_key(*tile)]
+        peak_lats.extend(cached_tile['lats'])
+        peak_lons.extend(cached_tile['lons'])
+        names.extend(cached_tile['names'])
+    return PeakIndex(np.array(peak_lats), np.array(peak_lons), names)
+
+
+def parse_flight_details(igc_path: Path) -> ParsedFlight:
+    """Parse an igc file and return details about the flight, without the
+    takeoff and landing locations which require network lookups
 
     Args:
         igc_path (Path): path to the flight IGC file
 
+    Raises:
+        ValueError: if the flight is invalid
+
     Returns:
-        Dict[str, Union[str, int, float]]: a dict containing stats about the flight
+        ParsedFlight: a dict containing stats about the flight and the
+        takeoff and landing positions (lat, lon)
     """
     flight = igc_lib.Flight.create_from_file(igc_path)
     if not flight.valid:
-        print(f"Flight {igc_path.name} is invalid: {flight.notes}")
-        return None
-    geolocator = Nominatim(user_agent="igc_flightbook")
-    location_takeoff = geolocator.reverse(
-        f"{flight.takeoff_fix.lat},{flight.takeoff_fix.lon}")
-    dt_takeoff = datetime.fromtimestamp(flight.takeoff_fix.timestamp)
-    location_landing = geolocator.reverse(
-        f"{flight.landing_fix.lat},{flight.landing_fix.lon}")
-
-    dt_landing = datetime.fromtimestamp(flight.landing_fix.timestamp)
-    landing_city = location_landing.raw['address'].get("city", '')
-    landing_village = location_landing.raw['address'].get("village", '')
-    location_landing_str = landing_city if landing_city else landing_village
-    thermal_gain = 0
-    thermal_velocities = []
-    for thermal in flight.thermals:
-        thermal_gain += round(thermal.alt_change())
-        thermal_velocities.append(thermal.vertical_velocity())
-    median_thermal_velocity = median(
-        thermal_velocities) if thermal_velocities else 0
-
-    return {
+        raise ValueError(f"Flight {igc_path.name} is invalid: {flight.notes}")
+    # IGC timestamps are UTC, convert without applying the local timezone
+    dt_takeoff = datetime.fromtimestamp(flight.takeoff_fix.timestamp,
+                                        tz=timezone.utc)
+    dt_landing = datetime.fromtimestamp(flight.landing_fix.timestamp,
+                                        tz=timezone.utc)
+    num_thermals = len(flight.thermals)
+    thermal_velocities = np.fromiter(
+        (thermal.vertical_velocity() for thermal in flight.thermals),
+        dtype=np.float64,
+        count=num_thermals)
+    thermal_gains = np.fromiter(
+        (thermal.alt_change() for thermal in flight.thermals),
+        dtype=np.float64,
+        count=num_thermals)
+    thermal_gain = int(np.rint(thermal_gains.sum()))
+    median_thermal_velocity = float(
+        np.median(thermal_velocities)) if num_thermals else 0
+
+    flight_details = {
         'Day': dt_landing.day,
         'Month': dt_landing.month,
         'Year': dt_landing.year,
         'Glider': flight.glider_type,
-        'Takeoff Time (UTC)': dt_takeoff.strftime('%H:%M'),
-        'Takeoff Location': find_closest_peak_to_location(location_takeoff),
+        'Takeoff Time (UTC)': f"{dt_takeoff.hour:02d}:{dt_takeoff.minute:02d}",
+        'Takeoff Location': None,
         'Takeoff lat,lon':
         f"{flight.takeoff_fix.lat},{flight.takeoff_fix.lon}",
         'GPS Altitude Takeoff (m)': flight.takeoff_fix.gnss_alt,
-        'Landing Time (UTC)': dt_landing.strftime('%H:%M'),
-        'Landing Location': location_landing_str,
+        'Landing Time (UTC)': f"{dt_landing.hour:02d}:{dt_landing.minute:02d}",
+        'Landing Location': None,
         'Landing lat,lon':
         f"{flight.landing_fix.lat},{flight.landing_fix.lon}",
         'GPS Altitude Landing (m)': flight.landing_fix.gnss_alt,
         'Airtime (min)': round((dt_landing - dt_takeoff).total_seconds() / 60),
-        'Number of thermals': len(flight.thermals),
+        'Number of thermals': num_thermals,
         'Thermal gain (m)': thermal_gain,
         'Median thermal velocity (m/s)': median_thermal_velocity,
         'IGC File': igc_path.name
     }
+    return (flight_details, (flight.takeoff_fix.lat, flight.takeoff_fix.lon),
+            (flight.landing_fix.lat, flight.landing_fix.lon))
+
+
+def locate_flight(
+        parsed_flight: ParsedFlight,
+        reverse: Callable,
+        peak_index: Optional[PeakIndex],
+        query_peaks_per_flight: bool = True) -> Tuple[FlightDetails, bool]:
+    """Fill in the takeoff and landing locations of a parsed flight
+
+    Args:
+        parsed_flight (ParsedFlight): result of parse_flight_details
+        reverse (Callable): (rate limited) geocoder reverse function
+        peak_index (Optional[PeakIndex]): prefetched peaks
+        query_peaks_per_flight (bool, optional): query Overpass per flight if
+            there is no peak index, otherwise leave the takeoff location
+            unresolved. Defaults to True.
+
+    Returns:
+        Tuple[FlightDetails, bool]: a dict containing stats about the flight
+        and whether all lookups succeeded
+    """
+    flight_details, takeoff, landing = parsed_flight
+    if peak_index is not None:
+        takeoff_location = peak_index.closest(*takeoff)
+    elif query_peaks_per_flight:
+        takeoff_location = find_closest_peak_to_location(*takeoff)
+    else:
+        takeoff_location = None
+    landing_location = find_landing_place(reverse, *landing)
+    flight_details['Takeoff Location'] = takeoff_location or 'Unknown Location'
+    flight_details['Landing Location'] = landing_location or ''
+    resolved = takeoff_location is not None and landing_location is not None
+    return flight_details, resolved
+
+
+def _flight_cache_key(igc_path: Path) -> str:
+    """Key identifying an unchanged IGC file in the flight cache
+
+    Args:
+        igc_path (Path): path to the flight IGC file
+
+    Returns:
+        str: key built from file name, size and modification time
+    """
+    stat = igc_path.stat()
+    return f"{igc_path.name}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def find_igc_files(folder: str) -> Iterator[Path]:
+    """Recursively find IGC files in a folder, skipping unreadable folders
+
+    Args:
+        folder (str): folder/tree to crawl
+
+    Yields:
+        Path: path to an IGC file
+    """
+    try:
+        entries = list(os.scandir(folder))
+    except OSError:
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from find_igc_files(entry.path)
+        elif entry.name[-4:].lower() == '.igc':
+            yield Path(entry.path)
+
+
+def write_flightbook(flight_dicts: List[FlightDetails], output_file: Path):
+    """Write flight details sorted by date and takeoff time to a csv file
+
+    Args:
+        flight_dicts (List[FlightDetails]): flight details
+        output_file (Path): csv file to write
+    """
+    df = pd.DataFrame(flight_dicts).sort_values(
+        ['Year', 'Month', 'Day', 'Takeoff Time (UTC)', 'IGC File'])
+    df.to_csv(output_file, sep=';', index=False, chunksize=10_000)
 
 
 def parse_flights(igc_folder: str, output_folder: str, output_filename: str):
@@ -135,25 +726,90 @@ def parse_flights(igc_folder: str, output_folder: str, output_filename: str):
     output_file = Path(output_folder) / Path(output_filename)
     flight_dicts = []
     print('Starting.')
-    igc_files_list = list(Path(igc_folder).rglob('*.[iI][gG][cC]'))
+    igc_files_list = list(find_igc_files(igc_folder))
     if not igc_files_list:
         print(f'No IGC files found in {igc_folder} and subfolders.')
         return
-    for i, igc_path in enumerate(igc_files_list):
-        print(
-            f"Processing flight {i + 1}/{len(igc_files_list)} {igc_path.name}",
-            flush=True)
-        flight_dict = parse_flight_details(igc_path)
+    _reverse_cache.update(_load_cache('nominatim'))
+    _peak_cache.update(_load_cache('closest_peaks'))
+    _peak_tile_cache.update(_load_cache('peak_tiles'))
+    _flight_cache.update(_load_cache('flights'))
+    igc_files_to_parse = []
+    for igc_path in igc_files_list:
+        flight_dict = _flight_cache.get(_flight_cache_key(igc_path))
         if flight_dict is not None:
             flight_dicts.append(flight_dict)
+        else:
+            igc_files_to_parse.append(igc_path)
+    if flight_dicts:
+        print(f'Loaded {len(flight_dicts)} flights from cache.')
+
+    # parsing is CPU bound, so it runs in processes to sidestep the GIL
+    parsed_flights = []
+    parsed_flight_keys = []
+    with ProcessPoolExecutor() as executor:
+        futures = [
+            executor.submit(parse_flight_details, igc_path)
+            for igc_path in igc_files_to_parse
+        ]
+        for i, (igc_path,
+                future) in enumerate(zip(igc_files_to_parse, futures)):
+            try:
+                parsed_flights.append(future.result())
+                parsed_flight_keys.append(_flight_cache_key(igc_path))
+            except ValueError as e:
+                print(e)
+                continue
+            print(
+                f"Parsed flight {i + 1}/{len(igc_files_to_parse)} {igc_path.name}",
+                flush=True)
+    if not parsed_flights and not flight_dicts:
+        print('No valid flights found.')
+        return
 
-        df = pd.DataFrame.from_dict(flight_dicts)
-        df = df.sort_values(['Year', 'Month', 'Day'])
-        df.to_csv(output_file, sep=';', index=False)
+    if parsed_flights:
+        _get_offline_geocoder()  # load once before the workers start
+        prefetch_landing_places(
+            [landing for _, _, landing in parsed_flights])
+        print('Fetching peaks.', flush=True)
+        # only query per flight if the region is too large, not if Overpass
+        # just refused the region query
+        query_peaks_per_flight = True
+        try:
+            peak_index = fetch_peaks(
+                [takeoff for _, takeoff, _ in parsed_flights])
+        except (overpy.exception.OverPyException, OSError) as e:
+            print(f'Could not fetch peaks, takeoff locations stay unknown: {e}')
+            peak_index = None
+            query_peaks_per_flight = False
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            flight_dict_iter = executor.map(
+                partial(locate_flight,
+                        reverse=_reverse,
+                        peak_index=peak_index,
+                        query_peaks_per_flight=query_peaks_per_flight),
+                parsed_flights)
+            for i, (key, (flight_dict, resolved)) in enumerate(
+                    zip(parsed_flight_keys, flight_dict_iter)):
+                print(
+                    f"Located flight {i + 1}/{len(parsed_flights)} {flight_dict['IGC File']}",
+                    flush=True)
+                flight_dicts.append(flight_dict)
+                # retry failed lookups on the next run
+                if resolved:
+                    _flight_cache[key] = flight_dict
+                if (i + 1) % CHECKPOINT_INTERVAL == 0:
+                    write_flightbook(flight_dicts, output_file)
+    write_flightbook(flight_dicts, output_file)
+    _save_cache('nominatim', _reverse_cache)
+    _save_cache('closest_peaks', _peak_cache)
+    _save_cache('peak_tiles', _peak_tile_cache)
+    _save_cache('flights', _flight_cache)
     print('Done.')
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     parser = argparse.ArgumentParser()
     parser.add_argument("igc_folder",
                         help="folder/tree to crawl for IGC files")